@@ -14,6 +14,11 @@ class TestSFTP(unittest.TestCase):
         self.sut = sftp.SFTP
         self.host = 'blah.sftp.com'
         self.ssh_home = '/home/.ssh'
+        sftp._CONFIG_CACHE.clear()
+        sftp._PKEY_CACHE.clear()
+        sftp._TRANSPORT_POOL.clear()
+        sftp._TRANSPORT_REFS.clear()
+        sftp._SFTP_CLIENT_CACHE.clear()
 
         # SFTP params
         self.remote_path = '/remote/data/nothing'
@@ -27,24 +32,27 @@ class TestSFTP(unittest.TestCase):
         # os mock
         self.mock_os = mock.Mock()
         self.mock_os.path.exists.return_value = True
+        self.mock_os.getcwd.return_value = '/local/data'
 
         # paramiko mock
         self.mock_paramiko = mock.Mock()
         self.mock_paramiko.SFTPClient.from_transport.return_value = mock.MagicMock()
         self.sftp_handle = self.mock_paramiko.SFTPClient.from_transport.return_value
         self.sftp_handle.get = mock.Mock()
+        self.sftp_handle.file = mock.Mock(return_value=mock.MagicMock())
         self.sftp_handle.listdir = mock.Mock()
+        self.sftp_handle.listdir_iter = mock.Mock()
         self.sftp_handle.put = mock.Mock()
         self.sftp_handle.remove = mock.Mock()
         self.sftp_handle.rename = mock.Mock()
         self.mock_get_transport = mock.Mock(return_value='mock_transport')
 
         self.remote_files = ['some_file.tgz', 'another_file.zip', 'further_file.tgz']
+        self.remote_file_entries = [mock.Mock(filename=remote_file) for remote_file in self.remote_files]
+        # os.path.join only builds the default config path & ssh home key paths now
         self.mock_os.path.join.side_effect = ['{ssh_home}/config'.format(ssh_home=self.ssh_home),
-                                              '/remote/data/nothing/some_file.tgz',
-                                              '/local/data/some_file.tgz',
-                                              '/remote/data/nothing/further_file.tgz',
-                                              '/local/data/further_file.tgz']
+                                              '{ssh_home}/id_rsa'.format(ssh_home=self.ssh_home),
+                                              '{ssh_home}/id_dsa'.format(ssh_home=self.ssh_home)]
 
     @contextmanager
     def limited_runner(self):
@@ -77,6 +85,17 @@ class TestSFTP(unittest.TestCase):
                 self.assertRaises(NoSSHConfigFound, sut._get_config)
 
 
+    def test_ssh_config_parse_cached_across_instances(self):
+        with self.limited_runner():
+            with mock.patch('sftp.os', self.mock_os):
+                # Test
+                config_path = '{ssh_home}/config'.format(ssh_home=self.ssh_home)
+                self.sut(self.host, ssh_config_path=config_path)._get_config()
+                self.sut(self.host, ssh_config_path=config_path)._get_config()
+                # Assert
+                self.assertEqual(self.mock_paramiko.SSHConfig.call_count, 1)
+                self.assertEqual(self.mock_paramiko.SSHConfig.return_value.lookup.call_count, 2)
+
     def test_get_private_key_expands_userdir(self):
         # Setup
         key_path = ' ~/.ssh/sftp-dsa' # Note the leading space - paramiko parsing bug may leave this.
@@ -94,6 +113,21 @@ class TestSFTP(unittest.TestCase):
                 '/home/me/.ssh/sftp-dsa')
 
 
+    def test_private_key_parse_cached_by_path(self):
+        # Setup
+        with mock.patch('sftp.paramiko', self.mock_paramiko),\
+             mock.patch('sftp.os', self.mock_os):
+
+            self.mock_os.path.expanduser.return_value = 'key'
+            self.mock_os.path.realpath.return_value = '/home/me/.ssh/key'
+            sut = self.sut(self.host)
+            # Test
+            first = sut._get_private_key('key')
+            second = sut._get_private_key('key')
+            # Assert
+            self.assertEqual(self.mock_paramiko.RSAKey.from_private_key_file.call_count, 1)
+            self.assertIs(first, second)
+
     def test_dss_key_returned_when_dsa_key_found(self):
         # Setup
         self.mock_paramiko.RSAKey.from_private_key_file.side_effect = paramiko.ssh_exception.SSHException
@@ -137,6 +171,83 @@ class TestSFTP(unittest.TestCase):
             self.mock_paramiko.Transport.return_value.connect.assert_has_calls([mock.call(**connect_args)])
             self.assertEqual(sut.ssh_config, None)
 
+    def test_transport_pooled_for_same_host_and_user(self):
+        # Setup
+        user = 'blah'
+        pkey = 'new_key'
+        mock_get_private_key = mock.Mock(return_value=pkey)
+
+        with \
+                mock.patch('sftp.paramiko', self.mock_paramiko), \
+                mock.patch('sftp.os', self.mock_os), \
+                mock.patch('sftp.SFTP._get_private_key', mock_get_private_key):
+            # Test
+            first = self.sut(self.host, user=user, pkey=pkey)
+            second = self.sut(self.host, user=user, pkey=pkey)
+            first.create_client()
+            second.create_client()
+
+            # Assert - one handshake, one channel, both shared by the second client
+            self.assertEqual(self.mock_paramiko.Transport.call_count, 1)
+            self.assertIs(first.transport, second.transport)
+            self.assertIs(first.sftp, second.sftp)
+            self.assertEqual(self.mock_paramiko.SFTPClient.from_transport.call_count, 1)
+
+    def test_close_keeps_pooled_transport_until_last_user(self):
+        # Setup
+        user = 'blah'
+        pkey = 'new_key'
+        mock_get_private_key = mock.Mock(return_value=pkey)
+
+        with \
+                mock.patch('sftp.paramiko', self.mock_paramiko), \
+                mock.patch('sftp.os', self.mock_os), \
+                mock.patch('sftp.SFTP._get_private_key', mock_get_private_key):
+            first = self.sut(self.host, user=user, pkey=pkey)
+            second = self.sut(self.host, user=user, pkey=pkey)
+            first.create_client()
+            second.create_client()
+
+            # Test & Assert - transport only really closes with its last user
+            first.close()
+            self.assertFalse(self.mock_paramiko.Transport.return_value.close.called)
+            second.close()
+            self.mock_paramiko.Transport.return_value.close.assert_called_once_with()
+
+    def test_close_of_stale_transport_leaves_new_pool_generation_alone(self):
+        # Setup
+        user = 'blah'
+        pkey = 'new_key'
+        mock_get_private_key = mock.Mock(return_value=pkey)
+        stale_transport = mock.MagicMock()
+        new_transport = mock.MagicMock()
+        stale_channel = mock.MagicMock()
+        new_channel = mock.MagicMock()
+        self.mock_paramiko.Transport.side_effect = [stale_transport, new_transport]
+        self.mock_paramiko.SFTPClient.from_transport.side_effect = [stale_channel, new_channel]
+
+        with \
+                mock.patch('sftp.paramiko', self.mock_paramiko), \
+                mock.patch('sftp.os', self.mock_os), \
+                mock.patch('sftp.SFTP._get_private_key', mock_get_private_key):
+            first = self.sut(self.host, user=user, pkey=pkey)
+            second = self.sut(self.host, user=user, pkey=pkey)
+            first.create_client()
+            # first's transport dies & second reconnects, starting a new generation
+            stale_transport.is_active.return_value = False
+            second.create_client()
+
+            # Test - the stale holder closes only its own resources
+            first.close()
+
+            # Assert
+            stale_channel.close.assert_called_once_with()
+            stale_transport.close.assert_called_once_with()
+            self.assertFalse(new_channel.close.called)
+            self.assertFalse(new_transport.close.called)
+            self.assertIs(sftp._TRANSPORT_POOL[second._pool_key], new_transport)
+            self.assertEqual(sftp._TRANSPORT_REFS[second._pool_key], 1)
+
     def test_ssh_config_used_when_user_and_pkey_undefined(self):
         # Setup
         pkey = 'home_key'
@@ -170,7 +281,6 @@ class TestSFTP(unittest.TestCase):
         connect_args = {'username': ssh_config['user'], 'pkey': home_key}
         mock_get_config = mock.Mock(return_value=ssh_config)
         self.mock_os.expand_user.return_value = self.ssh_home
-        self.mock_os.listdir.return_value = ['config', home_key]
         self.mock_paramiko.RSAKey.from_private_key_file.side_effect = [paramiko.ssh_exception.SSHException,
                                                                        'id_rsa']
         self.mock_paramiko.DSSKey.from_private_key_file.side_effect = [paramiko.ssh_exception.SSHException]
@@ -193,7 +303,8 @@ class TestSFTP(unittest.TestCase):
         ssh_config = {'hostname': 'some_host', 'port': 456, 'user': 'some_user'}
         mock_get_config = mock.Mock(return_value=ssh_config)
         self.mock_os.expand_user.return_value = self.ssh_home
-        self.mock_os.listdir.return_value = ['config']
+        #   ssh home exists but neither id_rsa nor id_dsa do
+        self.mock_os.path.exists.side_effect = [True, False, False]
         self.mock_paramiko.RSAKey.from_private_key_file.side_effect = [paramiko.ssh_exception.SSHException,
                                                                        paramiko.ssh_exception.SSHException]
         self.mock_paramiko.DSSKey.from_private_key_file.side_effect = [paramiko.ssh_exception.SSHException,
@@ -223,14 +334,19 @@ class TestSFTP(unittest.TestCase):
             self.sftp_handle.listdir.assert_has_calls([mock.call(*list_params)])
             self.assertEqual(returned_files, ['a', 'b', 'c'])
 
-    def test_get_file_calls_sftp_client_with_correct_calls(self):
+    def test_get_file_streams_remote_file_with_prefetch(self):
         # Setup
+        remote_handle = self.sftp_handle.file.return_value
+        remote_handle.read.side_effect = ['data', '']
         with self.default_runner():
             sut = self.sut(self.host)
             # Test
             sut.get_file(*self.get_params)
             # Assert
-            self.sftp_handle.get.assert_has_calls([mock.call(*self.get_params)])
+            self.sftp_handle.file.assert_has_calls([mock.call(self.remote_path, mode='rb')])
+            remote_handle.prefetch.assert_called_once_with()
+            self.file_handle.write.assert_has_calls([mock.call('data')])
+            remote_handle.close.assert_called_once_with()
 
     def test_remove_file_calls_sftp_client_with_correct_calls(self):
         # Setup
@@ -252,23 +368,35 @@ class TestSFTP(unittest.TestCase):
             # Assert
             self.sftp_handle.rename.assert_has_calls([mock.call(*rename_params)])
 
-    def test_upload_file_calls_sftp_client_with_correct_calls(self):
+    def test_upload_file_streams_local_file_pipelined(self):
         # Setup
         upload_params = ('/local/data/nothing', '/remote/data/nothing')
+        remote_handle = self.sftp_handle.file.return_value
+        self.file_handle.read.side_effect = ['data', '']
         with self.default_runner():
             sut = self.sut(self.host)
             # Test
             sut.upload_file(*upload_params)
             # Assert
-            self.sftp_handle.put.assert_has_calls([mock.call(*upload_params)])
+            self.sftp_handle.file.assert_has_calls([mock.call(upload_params[1], mode='wb')])
+            remote_handle.set_pipelined.assert_called_once_with(True)
+            remote_handle.write.assert_has_calls([mock.call('data')])
+            remote_handle.close.assert_called_once_with()
+
+    def test_upload_file_does_not_touch_remote_when_local_open_fails(self):
+        # Setup
+        upload_params = ('/local/data/nothing', '/remote/data/nothing')
+        self.mock_open.side_effect = IOError('no such file')
+        with self.default_runner():
+            sut = self.sut(self.host)
+            # Test & Assert - remote file must not be created/truncated
+            self.assertRaises(IOError, sut.upload_file, *upload_params)
+            self.assertFalse(self.sftp_handle.file.called)
 
     def test_upload_files_calls_sftp_client_with_correct_calls(self):
         # Setup
         upload_params = (['/local/data/nothing', '/local/foo/bar'], '/remote/data')
         self.mock_os.path.basename.side_effect = ['nothing', 'bar']
-        self.mock_os.path.join.side_effect = ['{ssh_home}/config'.format(ssh_home=self.ssh_home),
-                                              '/remote/data/nothing',
-                                              '/remote/data/bar']
 
         with self.default_runner():
             sut = self.sut(self.host)
@@ -276,53 +404,75 @@ class TestSFTP(unittest.TestCase):
             sut.upload_files(*upload_params)
 
             # Assert
+            # transfers run concurrently so completion order is not guaranteed
             self.sftp_handle.put.assert_has_calls([mock.call(upload_params[0][0], '/remote/data/nothing'),
-                                                   mock.call(upload_params[0][1], '/remote/data/bar')])
+                                                   mock.call(upload_params[0][1], '/remote/data/bar')],
+                                                  any_order=True)
 
     def test_get_files_starts_with_filter_returns_correct_list_of_files(self):
         # Setup
         starts_with = 'some_file'
-        self.sftp_handle.listdir.return_value = self.remote_files
+        self.sftp_handle.listdir_iter.return_value = self.remote_file_entries
 
         with self.default_runner():
             sut = self.sut(self.host)
             # Test
             sut.get_files(*self.get_params, starts_with=starts_with)
             # Assert
-            self.sftp_handle.listdir.assert_called_with(self.get_params[0])
+            self.sftp_handle.listdir_iter.assert_called_with(self.get_params[0])
             self.sftp_handle.get.assert_has_calls([mock.call('/remote/data/nothing/some_file.tgz',
-                                                             '/local/data/some_file.tgz')])
+                                                             '/local/data/nothing/some_file.tgz')])
 
     def test_get_files_ends_with_filter_returns_correct_list_of_files(self):
         # Setup
         ends_with = 'tgz'
-        self.sftp_handle.listdir.return_value = self.remote_files
+        self.sftp_handle.listdir_iter.return_value = self.remote_file_entries
 
         with self.default_runner():
             sut = self.sut(self.host)
             # Test
             sut.get_files(*self.get_params, ends_with=ends_with)
             # Assert
-            self.sftp_handle.listdir.assert_called_with(self.get_params[0])
+            self.sftp_handle.listdir_iter.assert_called_with(self.get_params[0])
+            # transfers run concurrently so completion order is not guaranteed
             self.sftp_handle.get.assert_has_calls([mock.call('/remote/data/nothing/some_file.tgz',
-                                                             '/local/data/some_file.tgz'),
+                                                             '/local/data/nothing/some_file.tgz'),
                                                    mock.call('/remote/data/nothing/further_file.tgz',
-                                                             '/local/data/further_file.tgz')])
+                                                             '/local/data/nothing/further_file.tgz')],
+                                                  any_order=True)
+
+    def test_get_files_without_filters_fetches_all_files(self):
+        # Setup
+        self.sftp_handle.listdir_iter.return_value = self.remote_file_entries
+
+        with self.default_runner():
+            sut = self.sut(self.host)
+            # Test
+            sut.get_files(*self.get_params)
+            # Assert
+            self.sftp_handle.listdir_iter.assert_called_with(self.get_params[0])
+            self.assertEqual(self.sftp_handle.get.call_count, len(self.remote_files))
+            self.sftp_handle.get.assert_has_calls([mock.call('/remote/data/nothing/another_file.zip',
+                                                             '/local/data/nothing/another_file.zip')],
+                                                  any_order=True)
 
     def test_get_files_with_delete_files_calls_sftp_client_remove(self):
         # Setup
         ends_with = 'tgz'
-        self.sftp_handle.listdir.return_value = self.remote_files
+        self.sftp_handle.listdir_iter.return_value = self.remote_file_entries
 
         with self.default_runner():
             sut = self.sut(self.host)
             # Test
             sut.get_files(self.remote_path, ends_with=ends_with, delete_files=True)
             # Assert
-            self.sftp_handle.listdir.assert_called_with(self.get_params[0])
+            self.sftp_handle.listdir_iter.assert_called_with(self.get_params[0])
+            # transfers run concurrently so completion order is not guaranteed
             self.sftp_handle.get.assert_has_calls([mock.call('/remote/data/nothing/some_file.tgz',
                                                              '/local/data/some_file.tgz'),
                                                    mock.call('/remote/data/nothing/further_file.tgz',
-                                                             '/local/data/further_file.tgz')])
+                                                             '/local/data/further_file.tgz')],
+                                                  any_order=True)
             self.sftp_handle.remove.assert_has_calls([mock.call('/remote/data/nothing/some_file.tgz'),
-                                                      mock.call('/remote/data/nothing/further_file.tgz')])
+                                                      mock.call('/remote/data/nothing/further_file.tgz')],
+                                                     any_order=True)